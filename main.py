@@ -3,42 +3,81 @@
 # Copyright (C) 2024 Bardia Moshiri <fakeshell@bardia.tech>
 
 import asyncio
+from random import uniform
+from signal import SIGINT, SIGTERM
+from logging import DEBUG
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
 from argparse import ArgumentParser
-from os.path import expanduser
+from os.path import expanduser, isdir
 from os import makedirs
 from tenacity import retry, wait_fixed
 
 from dbus_next.aio import MessageBus
 from dbus_next.service import ServiceInterface, method, dbus_property, signal
 from dbus_next.constants import PropertyAccess
-from dbus_next import DBusError, BusType, Variant
+from dbus_next import DBusError, BusType, Variant, SignatureTree
 
 from mmsd import OfonoMMSServiceInterface, OfonoMMSModemManagerInterface, OfonoMMSMessageInterface, OfonoPushNotification, Ofono, DBus
-from mmsd.utils import async_locked
-from mmsd.logging import mmsd_print
+from mmsd.utils import async_locked, EMPTY_STR_VARIANT
+from mmsd.logging import logger, setup_logging
 
 from mmsdecoder.message import MMSMessage
 
 has_bus = False
 
+# resolved once so per-message Variants skip the signature lookup
+_SIG_S = SignatureTree('s').types[0]
+_SIG_B = SignatureTree('b').types[0]
+_SIG_AS = SignatureTree('as').types[0]
+_SIG_ATTACHMENTS = SignatureTree('a(ssstt)').types[0]
+
+_UNUSED_OFONO_INTERFACES = frozenset({
+    "org.ofono.RadioSettings",
+    "org.ofono.NetworkMonitor",
+    "org.ofono.IpMultimediaSystem",
+    "org.ofono.SupplementaryServices",
+    "org.ofono.NetworkRegistration",
+    "org.ofono.MessageManager",
+    "org.ofono.NetworkTime",
+    "org.ofono.SmsHistory",
+    "org.ofono.SimAuthentication",
+    "org.ofono.VoiceCallManager",
+    "org.ofono.CellBroadcast",
+    "org.ofono.CallSettings",
+    "org.ofono.CallVolume",
+    "org.ofono.SimToolkit",
+    "org.ofono.Phonebook",
+    "org.ofono.SmartMessaging",
+    "org.ofono.CallBarring",
+    "org.ofono.CallForwarding",
+    "org.ofono.MessageWaiting",
+    "org.ofono.AllowedAccessPoints",
+    "org.nemomobile.ofono.CellInfo",
+    "org.nemomobile.ofono.SimInfo"
+})
+
 class OfonoMMSManagerInterface(ServiceInterface):
     def __init__(self, loop, system_bus, session_bus, verbose=False):
         super().__init__('org.ofono.mms.Manager')
-        mmsd_print("Initializing Manager interface", verbose)
+        logger.debug("Initializing Manager interface")
         self.loop = loop
         self.system_bus = system_bus
         self.session_bus = session_bus
         self.verbose = verbose
         self.ofono_client = Ofono(system_bus)
         self.dbus_client = DBus(system_bus)
-        self.ofono_mms_interfaces = []
-        self.ofono_mms_objects = []
+        self.ofono_mms_objects = {}
         self.ofono_proxy = []
         self.ofono_props = {}
         self.ofono_interfaces = {}
         self.ofono_interface_props = {}
         self.export_new_modem_tasks = {}
+        self.close_tasks = set()
+        self._modem_event = asyncio.Event()
+        self._modem_watched = {}
+        self._attached_event = asyncio.Event()
+        self._iface_handlers = {}
         self.modem_added_block = False
         self.ofono_mms_service_interface = False
         self.ofono_mms_modemmanager_interface = False
@@ -46,33 +85,9 @@ class OfonoMMSManagerInterface(ServiceInterface):
         self.already_exported = False
         self.home = expanduser("~")
         self.mms_dir = expanduser("~/.mms/modemmanager")
-        makedirs(self.mms_dir, exist_ok=True)
+        if not isdir(self.mms_dir):
+            makedirs(self.mms_dir, exist_ok=True)
         self.loop.create_task(self.check_ofono_presence())
-        self.unused_interfaces = {
-            "org.ofono.RadioSettings",
-            "org.ofono.NetworkMonitor",
-            "org.ofono.IpMultimediaSystem",
-            "org.ofono.SupplementaryServices",
-            "org.ofono.NetworkRegistration",
-            "org.ofono.MessageManager",
-            "org.ofono.NetworkTime",
-            "org.ofono.SmsHistory",
-            "org.ofono.SimAuthentication",
-            "org.ofono.VoiceCallManager",
-            "org.ofono.CellBroadcast",
-            "org.ofono.CallSettings",
-            "org.ofono.CallVolume",
-            "org.ofono.SimToolkit",
-            "org.ofono.Phonebook",
-            "org.ofono.SmartMessaging",
-            "org.ofono.CallBarring",
-            "org.ofono.CallForwarding",
-            "org.ofono.MessageWaiting",
-            "org.ofono.AllowedAccessPoints",
-            "org.nemomobile.ofono.CellInfo",
-            "org.nemomobile.ofono.SimInfo"
-        }
-
         self.required_interfaces = {
             "org.ofono.ConnectionManager",
             "org.ofono.PushNotification",
@@ -87,28 +102,28 @@ class OfonoMMSManagerInterface(ServiceInterface):
 
     @method()
     async def GetServices(self) -> 'a(oa{sv})':
-        mmsd_print("Getting services", self.verbose)
+        logger.debug("Getting services")
 
         if not self.ofono_mms_service_interface:
             try:
                 await self.find_ofono_modems()
             except Exception as e:
-                mmsd_print(f"Failed to get services: {e}", self.verbose)
+                logger.debug("Failed to get services: %s", e)
 
         return self.props['services']
 
     @signal()
     def ServiceAdded(self, path: 'o', properties: 'a{sv}') -> 'oa{sv}':
-        mmsd_print(f"Service added emitted with path {path} and properties {properties}", self.verbose)
+        logger.debug("Service added emitted with path %s and properties %s", path, properties)
         return [path, properties]
 
     @signal()
     def ServiceRemoved(self, path: 'o') -> 'o':
-        mmsd_print(f"Service removed emitted with path {path}", self.verbose)
+        logger.debug("Service removed emitted with path %s", path)
         return path
 
     async def check_ofono_presence(self):
-        mmsd_print("Checking ofono presence", self.verbose)
+        logger.debug("Checking ofono presence")
 
         dbus_iface = self.dbus_client["dbus"]["/org/freedesktop/DBus"]["org.freedesktop.DBus"]
         dbus_iface.on_name_owner_changed(self.dbus_name_owner_changed)
@@ -119,7 +134,7 @@ class OfonoMMSManagerInterface(ServiceInterface):
             self.ofono_removed()
 
     def ofono_added(self):
-        mmsd_print("oFono added", self.verbose)
+        logger.debug("oFono added")
 
         self.ofono_manager_interface = self.ofono_client["ofono"]["/"]["org.ofono.Manager"]
         self.ofono_manager_interface.on_modem_added(self.ofono_modem_added)
@@ -127,17 +142,27 @@ class OfonoMMSManagerInterface(ServiceInterface):
         self.loop.create_task(self.find_ofono_modems())
 
     def ofono_removed(self):
-        mmsd_print("oFono removed", self.verbose)
+        logger.debug("oFono removed")
+        # the client hands back the same cached proxies when oFono comes back, detach our handlers
+        # or every restart adds another copy of them
+        if self.ofono_manager_interface:
+            self.ofono_manager_interface.off_modem_added(self.ofono_modem_added)
+            self.ofono_manager_interface.off_modem_removed(self.ofono_modem_removed)
         self.ofono_manager_interface = None
+        for path, ch in self._modem_watched.items():
+            self.ofono_client["ofono_modem"][path]['org.ofono.Modem'].off_property_changed(ch)
+        self._modem_watched.clear()
+        # wake up find_ofono_modems so it notices the manager is gone
+        self._modem_event.set()
 
     @async_locked
     async def find_ofono_modems(self):
-        mmsd_print("Finding oFono modems", self.verbose)
+        logger.debug("Finding oFono modems")
 
         global has_bus
 
         if not self.ofono_manager_interface:
-            mmsd_print("oFono manager interface is empty, skipping", self.verbose)
+            logger.debug("oFono manager interface is empty, skipping")
             return
 
         self.ofono_modem_list = False
@@ -145,13 +170,15 @@ class OfonoMMSManagerInterface(ServiceInterface):
         while not self.ofono_modem_list:
             try:
                 if self.ofono_manager_interface is None:
-                    mmsd_print("oFono manager interface is not initialized properly. skipping", self.verbose)
+                    logger.debug("oFono manager interface is not initialized properly. skipping")
                     return
 
+                self._modem_event.clear()
                 modems = await self.ofono_manager_interface.call_get_modems()
 
-                for modem in modems:
-                    mmsd_print(f"Modems available in oFono: {modem[0]}", self.verbose)
+                # the path list is built eagerly, only bother when debug output is on
+                if logger.isEnabledFor(DEBUG):
+                    logger.debug("Modems available in oFono: %s", [modem[0] for modem in modems])
 
                 self.ofono_modem_list = [
                     x
@@ -160,24 +187,29 @@ class OfonoMMSManagerInterface(ServiceInterface):
                 ]
 
                 if not self.ofono_modem_list:
-                    mmsd_print("No modems available, retrying", self.verbose)
-                    await asyncio.sleep(2)
+                    logger.debug("No modems available, waiting for oFono to add one")
+                    await self._modem_event.wait()
                     continue
 
                 modem_interfaces = set(self.ofono_modem_list[0][1]['Interfaces'].value)
                 if not self.required_interfaces.issubset(modem_interfaces):
-                    mmsd_print("Required interfaces not available, retrying", self.verbose)
-                    await asyncio.sleep(2)
+                    logger.debug("Required interfaces not available, waiting for modem interfaces to change")
+                    self.watch_modem_interfaces(self.ofono_modem_list[0][0])
+                    try:
+                        await asyncio.wait_for(self._modem_event.wait(), 2)
+                        self.ofono_modem_list = False
+                    except asyncio.TimeoutError:
+                        pass
                     continue
             except DBusError as e:
-                mmsd_print(f"Failed to get the current modem: {e}", self.verbose)
+                logger.debug("Failed to get the current modem: %s", e)
                 self.ofono_modem_list = False
 
         for modem in self.ofono_modem_list:
             try:
                 self.ofono_sim_manager = self.ofono_client["ofono_modem"][modem[0]]['org.ofono.SimManager']
 
-                mmsd_print(f"modem is {modem[0]}", self.verbose)
+                logger.debug("modem is %s", modem[0])
 
                 task = self.loop.create_task(self.export_new_modem(modem[0], modem[1]))
                 self.export_new_modem_tasks[modem[0]] = task
@@ -192,31 +224,45 @@ class OfonoMMSManagerInterface(ServiceInterface):
 
     def dbus_name_owner_changed(self, name, old_owner, new_owner):
         if name == "org.ofono":
-            mmsd_print(f"oFono name owner changed, name: {name}, old owner: {old_owner}, new owner: {new_owner}", self.verbose)
+            logger.debug("oFono name owner changed, name: %s, old owner: %s, new owner: %s", name, old_owner, new_owner)
             if new_owner == "":
                 self.ofono_removed()
             elif old_owner == "":
                 self.ofono_added()
 
+    def watch_modem_interfaces(self, path):
+        if path in self._modem_watched:
+            return
+
+        def ch(name, varval):
+            if name == "Interfaces":
+                self._modem_event.set()
+
+        self.ofono_client["ofono_modem"][path]['org.ofono.Modem'].on_property_changed(ch)
+        self._modem_watched[path] = ch
+
     def ofono_modem_added(self, path, mprops):
-        mmsd_print(f"oFono modem added at path {path} and properties {mprops}", self.verbose)
+        logger.debug("oFono modem added at path %s and properties %s", path, mprops)
+
+        if path.startswith("/ril_"):
+            self._modem_event.set()
 
         if self.modem_added_block:
-            mmsd_print("oFono modem block is on, skipping", self.verbose)
+            logger.debug("oFono modem block is on, skipping")
             return
 
         try:
             task = self.loop.create_task(self.export_new_modem(path, mprops))
             self.export_new_modem_tasks[path] = task
         except Exception as e:
-            mmsd_print(f"Failed to create task for modem {path}: {e}", self.verbose)
+            logger.debug("Failed to create task for modem %s: %s", path, e)
 
     @retry(wait=wait_fixed(3))
     async def export_new_modem(self, path, mprops):
         try:
-            mmsd_print(f"Processing modem {path} with properties {mprops}", self.verbose)
+            logger.debug("Processing modem %s with properties %s", path, mprops)
             if self.already_exported:
-                mmsd_print(f"Skipping modem: {path}. dual sim is not yet supported by MMSD", self.verbose)
+                logger.debug("Skipping modem: %s. dual sim is not yet supported by MMSD", path)
                 return
 
             self.ofono_props = mprops
@@ -225,46 +271,43 @@ class OfonoMMSManagerInterface(ServiceInterface):
             await self.init_ofono_interfaces()
 
             contexts = await self.ofono_interfaces['org.ofono.ConnectionManager'].call_get_contexts()
-            for ctx in contexts:
-                name = ctx[1].get('Type', Variant('s', '')).value
-                if name.lower() == "mms":
-                    ctx_path = ctx[0]
+            mms_contexts = [ctx[0] for ctx in contexts if ctx[1].get('Type', EMPTY_STR_VARIANT).value.lower() == "mms"]
+            if mms_contexts:
+                # force_activate_context already activates every mms context, no need to run it per context
+                await self.force_activate_context()
+                for ctx_path in mms_contexts:
                     ctx_interface = self.ofono_client["ofono_context"][ctx_path]['org.ofono.ConnectionContext']
-                    await self.force_activate_context()
                     ctx_interface.on_property_changed(self.context_active_changed)
 
             if "/org/ofono/mms" not in self.ofono_mms_objects:
                 self.ofono_mms_modemmanager_interface = OfonoMMSModemManagerInterface(self.ofono_client, self.ofono_props, self.ofono_interfaces, self.ofono_interface_props, self.mms_dir, path, self.verbose)
                 self.session_bus.export('/org/ofono/mms', self.ofono_mms_modemmanager_interface)
                 await self.ofono_mms_modemmanager_interface.set_props()
-                self.ofono_mms_interfaces.append(self.ofono_mms_modemmanager_interface)
-                self.ofono_mms_objects.append('/org/ofono/mms')
+                self.ofono_mms_objects['/org/ofono/mms'] = self.ofono_mms_modemmanager_interface
             else:
-                mmsd_print("Skip exporting mms modem manager interface at /org/ofono/mms, path is already exported", self.verbose)
+                logger.debug("Skip exporting mms modem manager interface at /org/ofono/mms, path is already exported")
 
             if self.props['services'][0][0] not in self.ofono_mms_objects:
                 self.ofono_mms_service_interface = OfonoMMSServiceInterface(self.ofono_client, self.ofono_props, self.ofono_interfaces, self.ofono_interface_props, self.mms_dir, self.ofono_mms_modemmanager_interface, self.export_mms_message, path, self.verbose)
                 self.session_bus.export(self.props['services'][0][0], self.ofono_mms_service_interface)
                 self.ofono_mms_service_interface.set_props()
-                self.ofono_mms_interfaces.append(self.ofono_mms_service_interface)
-                self.ofono_mms_objects.append(self.props['services'][0][0])
+                self.ofono_mms_objects[self.props['services'][0][0]] = self.ofono_mms_service_interface
             else:
-                mmsd_print("Skip exporting mms service interface at /org/ofono/mms/modemmanager, path is already exported", self.verbose)
+                logger.debug("Skip exporting mms service interface at /org/ofono/mms/modemmanager, path is already exported")
 
             self.ofono_push_notification_interface = OfonoPushNotification(self.system_bus, self.ofono_client, self.ofono_props, self.ofono_interfaces, self.ofono_interface_props, self.mms_dir, self.export_mms_message, path, self.verbose)
             await self.ofono_push_notification_interface.RegisterAgent('/mmsd')
-            self.ofono_mms_interfaces.append(self.ofono_push_notification_interface)
-            self.ofono_mms_objects.append('/mmsd')
+            self.ofono_mms_objects['/mmsd'] = self.ofono_push_notification_interface
 
             try:
-                self.ofono_push_notification_interface.export_old_messages()
+                await self.ofono_push_notification_interface.export_old_messages()
             except Exception as e:
-                mmsd_print(f"Failed to export old messages: {e}", self.verbose)
+                logger.debug("Failed to export old messages: %s", e)
 
             self.modem_added_block = False
             self.already_exported = True
         except asyncio.CancelledError:
-            mmsd_print(f"export_new_modem task cancelled for path {path}", self.verbose)
+            logger.debug("export_new_modem task cancelled for path %s", path)
             raise  # Re-raise the CancelledError to properly handle the cancellation
         finally:
             if path in self.export_new_modem_tasks:
@@ -272,24 +315,25 @@ class OfonoMMSManagerInterface(ServiceInterface):
 
     def export_mms_message(self, uuid, status, date, sender, delivery_report, recipients, smil, attachments):
         ofono_mms_message = OfonoMMSMessageInterface(self.mms_dir, uuid, self.delete_mms_message, self.verbose)
+        modem_number = self.ofono_mms_modemmanager_interface.props['ModemNumber'].value
 
         if status == 'received' and not recipients:
-            recipients.append(self.ofono_mms_modemmanager_interface.props['ModemNumber'].value)
+            recipients.append(modem_number)
 
         props_array = {
-            'Status': Variant('s', status),
-            'Date': Variant('s', date),
-            'Subject': Variant('s', ''),
-            'Sender': Variant('s', sender),
-            'Delivery Report': Variant('b', delivery_report),
-            'Modem Number': Variant('s', self.ofono_mms_modemmanager_interface.props['ModemNumber'].value),
-            'Recipients': Variant('as', recipients),
-            'Smil': Variant('s', smil),
-            'Attachments': Variant('a(ssstt)', attachments)
+            'Status': Variant(_SIG_S, status),
+            'Date': Variant(_SIG_S, date),
+            'Subject': Variant(_SIG_S, ''),
+            'Sender': Variant(_SIG_S, sender),
+            'Delivery Report': Variant(_SIG_B, delivery_report),
+            'Modem Number': Variant(_SIG_S, modem_number),
+            'Recipients': Variant(_SIG_AS, recipients),
+            'Smil': Variant(_SIG_S, smil),
+            'Attachments': Variant(_SIG_ATTACHMENTS, attachments)
         }
 
         if status == 'sent':
-            props_array['Status'] = Variant('s', 'draft')
+            props_array['Status'] = Variant(_SIG_S, 'draft')
 
         ofono_mms_message.update_properties(props_array)
 
@@ -297,11 +341,12 @@ class OfonoMMSManagerInterface(ServiceInterface):
 
         self.session_bus.export(object_path, ofono_mms_message)
 
-        self.ofono_mms_service_interface.messages.append([object_path, props_array])
+        self.ofono_mms_service_interface.messages[object_path] = props_array
+        self.ofono_mms_service_interface.message_interfaces[object_path] = ofono_mms_message
         self.ofono_mms_service_interface.MessageAdded(object_path, props_array)
 
         if status == 'sent':
-            props_array['Status'] = Variant('s', status)
+            props_array['Status'] = Variant(_SIG_S, status)
 
         ofono_mms_message.update_properties(props_array)
         ofono_mms_message.PropertyChanged('status', props_array['Status'])
@@ -310,88 +355,138 @@ class OfonoMMSManagerInterface(ServiceInterface):
 
     def delete_mms_message(self, uuid):
         object_path = f"{self.props['services'][0][0]}/{uuid}"
-        mmsd_print(f"Unexporting MMS message at path {object_path}", self.verbose)
+        logger.debug("Unexporting MMS message at path %s", object_path)
         self.session_bus.unexport(object_path)
-        for message in self.ofono_mms_service_interface.messages:
-            if message[0] == object_path:
-                self.ofono_mms_service_interface.messages.remove(message)
-                break
+        self.ofono_mms_service_interface.messages.pop(object_path, None)
+        self.ofono_mms_service_interface.message_interfaces.pop(object_path, None)
 
         self.ofono_mms_service_interface.MessageRemoved(object_path)
 
     async def force_activate_context(self):
+        delay = 0.25
+        # an attach from before this call is already covered by the first attempt
+        self._attached_event.clear()
         while True:
+            was_attached = self.modem_attached()
             try:
                 ret = await self.activate_mms_context()
                 if ret == True:
                     return
             except Exception as e:
-                mmsd_print(f"Failed to activate context: {e}", self.verbose)
+                logger.debug("Failed to activate context: %s", e)
+
+            # back off, but retry right away once the modem attaches to the network. the attach
+            # may already have happened while we were activating, so don't wait in that case
+            if not self._attached_event.is_set() and (was_attached or not self.modem_attached()):
+                try:
+                    await asyncio.wait_for(self._attached_event.wait(), delay + uniform(0, delay * 0.1))
+                except asyncio.TimeoutError:
+                    pass
+            # only forget the attach once it has been acted on
+            self._attached_event.clear()
+
+            delay = min(delay * 2, 30)
 
-            await asyncio.sleep(2)
+    def modem_attached(self):
+        attached = self.ofono_interface_props.get('org.ofono.ConnectionManager', {}).get('Attached')
+        return attached is not None and attached.value
 
     async def context_active_changed(self, property, propvalue):
-        mmsd_print(f"property: {property}, value: {propvalue}", self.verbose)
+        logger.debug("property: %s, value: %s", property, propvalue)
+        if self.ofono_push_notification_interface:
+            self.ofono_push_notification_interface.mms_context_changed()
         if property == "Active":
             if propvalue.value == False:
-                mmsd_print("oFono MMS connection dropped while we still need it, reactivating context", self.verbose)
+                logger.debug("oFono MMS connection dropped while we still need it, reactivating context")
                 await self.force_activate_context()
+            elif self.ofono_push_notification_interface:
+                self.ofono_push_notification_interface.network_restored()
 
     async def activate_mms_context(self):
         try:
             contexts = await self.ofono_interfaces['org.ofono.ConnectionManager'].call_get_contexts()
-            for ctx in contexts:
-                type = ctx[1].get('Type', Variant('s', '')).value
-                if type.lower() == "mms":
-                    ofono_ctx_interface = self.ofono_client["ofono_context"][ctx[0]]["org.ofono.ConnectionContext"]
-                    await ofono_ctx_interface.call_set_property("Active", Variant('b', True))
+            activations = [
+                self.ofono_client["ofono_context"][ctx[0]]["org.ofono.ConnectionContext"].call_set_property("Active", Variant('b', True))
+                for ctx in contexts if ctx[1].get('Type', EMPTY_STR_VARIANT).value.lower() == "mms"
+            ]
+            results = await asyncio.gather(*activations, return_exceptions=True)
+            for result in results:
+                if not isinstance(result, Exception):
                     return True
+
+            for result in results:
+                logger.debug("Failed to activate MMS context: %s", result)
+            return False
         except Exception as e:
-            mmsd_print(f"Failed to activate MMS context: {e}", self.verbose)
+            logger.debug("Failed to activate MMS context: %s", e)
             return False
 
     def ofono_modem_removed(self, path):
-        mmsd_print(f"oFono modem removed at path {path}", self.verbose)
-        mmsd_print(f"Exported object paths before unexporting: {self.ofono_mms_objects}", self.verbose)
+        logger.debug("oFono modem removed at path %s", path)
+        logger.debug("Exported object paths before unexporting: %s", list(self.ofono_mms_objects))
 
         if path in self.export_new_modem_tasks:
             task = self.export_new_modem_tasks[path]
             if not task.done():
                 task.cancel()
-                mmsd_print(f"Cancelled export_new_modem task for path {path}", self.verbose)
+                logger.debug("Cancelled export_new_modem task for path %s", path)
             del self.export_new_modem_tasks[path]
 
+        if self.ofono_push_notification_interface:
+            self.close_soon(self.ofono_push_notification_interface)
         self.ofono_push_notification_interface = False
 
-        objects_to_remove = []
-        for ofono_mms_object in self.ofono_mms_objects:
+        # only the push notification agent is tied to the modem, the mms service and modem manager stay exported
+        ofono_mms = self.ofono_mms_objects.get("/mmsd")
+        if ofono_mms and ofono_mms.modem_name == path:
             try:
-                for ofono_mms in self.ofono_mms_interfaces:
-                    if ofono_mms.modem_name == path:
-                        if ofono_mms_object == "/mmsd":
-                            mmsd_print(f"oFono modem at object path {ofono_mms.modem_name} matches our modem interface path, unexporting {ofono_mms_object}", self.verbose)
-                            self.session_bus.unexport(ofono_mms_object)
-                            self.ofono_mms_objects.remove("/mmsd")
-                            break
+                logger.debug("oFono modem at object path %s matches our modem interface path, unexporting /mmsd", ofono_mms.modem_name)
+                self.session_bus.unexport("/mmsd")
+                del self.ofono_mms_objects["/mmsd"]
             except Exception as e:
-                mmsd_print(f"Failed to unexport modem at path {path} with object path {ofono_mms}: {e}", self.verbose)
+                logger.debug("Failed to unexport modem at path %s with object path /mmsd: %s", path, e)
 
-        mmsd_print(f"Exported object paths after unexporting: {self.ofono_mms_objects}", self.verbose)
+        logger.debug("Exported object paths after unexporting: %s", list(self.ofono_mms_objects))
 
         self.already_exported = False
         self.modem_added_block = False
 
+    async def close(self):
+        for interface in (self.ofono_push_notification_interface, self.ofono_mms_service_interface):
+            if interface:
+                await interface.close()
+
+    def close_soon(self, interface):
+        # the loop only keeps weak references to tasks, hold on to them until the close finishes
+        task = self.loop.create_task(interface.close())
+        self.close_tasks.add(task)
+        task.add_done_callback(self.close_tasks.discard)
+
     async def init_ofono_interfaces(self):
-        mmsd_print("Initialize oFono interfaces", self.verbose)
+        logger.debug("Initialize oFono interfaces")
+
+        interfaces = self.ofono_props['Interfaces'].value
+        results = await asyncio.gather(*[
+            self.fetch_ofono_interface(iface)
+            for iface in interfaces
+        ], return_exceptions=True)
+
+        # let every fetch finish, then hand the first failure to export_new_modem's retry
+        errors = []
+        for iface, result in zip(interfaces, results):
+            if isinstance(result, Exception):
+                logger.debug("Failed to add oFono interface %s: %s", iface, result)
+                errors.append(result)
+        if errors:
+            raise errors[0]
 
-        for iface in self.ofono_props['Interfaces'].value:
-            await self.add_ofono_interface(iface)
+        await self.set_sub_interface_props()
 
     def ofono_changed(self, name, varval):
         self.ofono_props[name] = varval
         if name == "Interfaces":
             for iface in varval.value:
-                if not (iface in self.ofono_interfaces):
+                if not (iface in self.ofono_interfaces) and not (iface in _UNUSED_OFONO_INTERFACES):
                     self.loop.create_task(self.add_ofono_interface(iface))
             for iface in self.ofono_interfaces:
                 if not (iface in varval.value):
@@ -406,22 +501,31 @@ class OfonoMMSManagerInterface(ServiceInterface):
 
     def ofono_interface_changed(self, iface):
         def ch(name, varval):
+            if iface == "org.ofono.ConnectionManager" and name == "Attached" and varval.value:
+                self._attached_event.set()
+
             if iface in self.ofono_interface_props:
                 self.ofono_interface_props[iface][name] = varval
-                if self.ofono_mms_service_interface:
-                    self.ofono_mms_service_interface.ofono_interface_changed(iface)(name, varval)
-                if self.ofono_mms_modemmanager_interface:
-                    self.ofono_mms_modemmanager_interface.ofono_interface_changed(iface)(name, varval)
-                if self.ofono_push_notification_interface:
-                    self.ofono_push_notification_interface.ofono_interface_changed(iface)(name, varval)
+                for handler in self.sub_interface_handlers(iface):
+                    handler(name, varval)
         return ch
 
-    async def add_ofono_interface(self, iface):
-        if iface in self.unused_interfaces:
-            mmsd_print(f"Interface is {iface} which is unused, skipping", self.verbose)
-            return
+    def sub_interface_handlers(self, iface):
+        # sub interfaces come and go with the modem, rebuild the handlers only when they change
+        sub_interfaces = (self.ofono_mms_service_interface, self.ofono_mms_modemmanager_interface, self.ofono_push_notification_interface)
+        cached = self._iface_handlers.get(iface)
+        if cached is None or cached[0] != sub_interfaces:
+            cached = (sub_interfaces, [sub.ofono_interface_changed(iface) for sub in sub_interfaces if sub])
+            self._iface_handlers[iface] = cached
+
+        return cached[1]
+
+    async def fetch_ofono_interface(self, iface):
+        if iface in _UNUSED_OFONO_INTERFACES:
+            logger.debug("Interface is %s which is unused, skipping", iface)
+            return False
         else:
-            mmsd_print(f"Add oFono interface for iface {iface}", self.verbose)
+            logger.debug("Add oFono interface for iface %s", iface)
 
         self.ofono_interfaces.update({
             iface: self.ofono_proxy[iface]
@@ -432,58 +536,40 @@ class OfonoMMSManagerInterface(ServiceInterface):
                 iface: await self.ofono_interfaces[iface].call_get_properties()
             })
 
-            if self.ofono_mms_service_interface:
-                self.ofono_mms_service_interface.ofono_interface_props = self.ofono_interface_props.copy()
-
-            if self.ofono_mms_modemmanager_interface:
-                self.ofono_mms_modemmanager_interface.ofono_interface_props = self.ofono_interface_props.copy()
-
-            if self.ofono_push_notification_interface:
-                self.ofono_push_notification_interface.ofono_interface_props = self.ofono_interface_props.copy()
-
             self.ofono_interfaces[iface].on_property_changed(self.ofono_interface_changed(iface))
         except DBusError:
             self.ofono_interface_props.update({
                 iface: {}
             })
 
-            if self.ofono_mms_service_interface:
-                self.ofono_mms_service_interface.ofono_interface_props = self.ofono_interface_props.copy()
-
-            if self.ofono_mms_modemmanager_interface:
-                self.ofono_mms_modemmanager_interface.ofono_interface_props = self.ofono_interface_props.copy()
-
-            if self.ofono_push_notification_interface:
-                self.ofono_push_notification_interface.ofono_interface_props = self.ofono_interface_props.copy()
-
             self.ofono_interfaces[iface].on_property_changed(self.ofono_interface_changed(iface))
         except AttributeError:
             pass
 
+        return True
+
+    async def set_sub_interface_props(self):
         if self.ofono_mms_service_interface:
             self.ofono_mms_service_interface.set_props()
 
         if self.ofono_mms_modemmanager_interface:
             await self.ofono_mms_modemmanager_interface.set_props()
 
+    async def add_ofono_interface(self, iface):
+        if not await self.fetch_ofono_interface(iface):
+            return
+
+        await self.set_sub_interface_props()
+
     async def remove_ofono_interface(self, iface):
-        mmsd_print(f"Remove oFono interface for iface {iface}", self.verbose)
+        logger.debug("Remove oFono interface for iface %s", iface)
 
         if iface in self.ofono_interfaces:
             self.ofono_interfaces.pop(iface)
         if iface in self.ofono_interface_props:
             self.ofono_interface_props.pop(iface)
 
-        if self.ofono_mms_service_interface:
-            self.ofono_mms_service_interface.ofono_interface_props = self.ofono_interface_props.copy()
-            self.ofono_mms_service_interface.set_props()
-
-        if self.ofono_mms_modemmanager_interface:
-            self.ofono_mms_modemmanager_interface.ofono_interface_props = self.ofono_interface_props.copy()
-            await self.ofono_mms_modemmanager_interface.set_props()
-
-        if self.ofono_push_notification_interface:
-            self.ofono_push_notification_interface.ofono_interface_props = self.ofono_interface_props.copy()
+        await self.set_sub_interface_props()
 
 def get_version():
     return "2.6.1"
@@ -517,12 +603,21 @@ async def main():
     else:
         verbose = args.verbose
 
+    setup_logging(verbose)
+
     system_bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
     session_bus = await MessageBus(bus_type=BusType.SESSION).connect()
     loop = asyncio.get_running_loop()
+    # mms pdu parsing is pushed to the default executor, keep it small
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=2))
+    for sig in (SIGINT, SIGTERM):
+        loop.add_signal_handler(sig, session_bus.disconnect)
+
     ofono_mms_manager_interface = OfonoMMSManagerInterface(loop, system_bus, session_bus, verbose=verbose)
     session_bus.export('/org/ofono/mms', ofono_mms_manager_interface)
     await session_bus.wait_for_disconnect()
+    await ofono_mms_manager_interface.close()
+    system_bus.disconnect()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -13,4 +13,5 @@ __all__ = [
 	"OfonoMMSMessageInterface",
 	"OfonoPushNotification",
 	"Ofono",
+	"DBus",
 ]
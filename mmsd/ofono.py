@@ -40,40 +40,54 @@ class CachedClient:
         self.bus = bus
         self.cache = {}
 
-        # Load introspections
-        for introspection, path in self.introspections.items():
-            with open(path, "r") as f:
-                self.cache[hash(introspection)] = f.read()
+    def get_introspection(self, introspection):
+        """
+        Returns the introspection XML, reading it from disk on first use.
+        """
+
+        intro_key = ("intro", introspection)
+
+        if not intro_key in self.cache:
+            with open(self.introspections[introspection], "r") as f:
+                self.cache[intro_key] = f.read()
+
+        return self.cache[intro_key]
 
     def get_interface(self, introspection, path, interface):
-        path_hashed = hash(path)
-        interface_hashed = hash(path + interface)
+        cache = self.cache
+        path_key = ("path", path)
+        interface_key = ("iface", path, interface)
 
-        if not interface_hashed in self.cache:
-            if not path_hashed in self.cache:
-                self.cache[path_hashed] = self.bus.get_proxy_object(self.bus_name, path, self.cache[hash(introspection)])
+        if not interface_key in cache:
+            if not path_key in cache:
+                cache[path_key] = self.bus.get_proxy_object(self.bus_name, path, self.get_introspection(introspection))
 
             try:
-                self.cache[interface_hashed] = self.cache[path_hashed].get_interface(interface)
+                cache[interface_key] = cache[path_key].get_interface(interface)
             except Exception:
-                self.cache[interface_hashed] = None  # skip over org.ofono.IpMultimediaSystem
+                cache[interface_key] = None  # skip over org.ofono.IpMultimediaSystem
 
-        return self.cache[interface_hashed]
+        return cache[interface_key]
+
+    def get_object_proxy(self, introspection, path):
+        proxy_key = ("proxy", introspection, path)
+
+        if not proxy_key in self.cache:
+            self.cache[proxy_key] = ObjectProxy(self, CachedClient.get_interface, [introspection, path])
+
+        return self.cache[proxy_key]
 
     def __getitem__(self, introspection):
         """
         Returns a proxy object
         """
 
-        return ObjectProxy(
-            self,
-            lambda proxy, *args: ObjectProxy(
-                    self,
-                    CachedClient.get_interface,
-                    [introspection, args[-1]] # UGLY
-            ),
-            [introspection]
-        )
+        proxy_key = ("proxy", introspection)
+
+        if not proxy_key in self.cache:
+            self.cache[proxy_key] = ObjectProxy(self, CachedClient.get_object_proxy, [introspection])
+
+        return self.cache[proxy_key]
 
 class Ofono(CachedClient):
 
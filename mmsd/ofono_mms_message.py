@@ -2,19 +2,19 @@
 # Copyright (C) 2024 Bardia Moshiri <fakeshell@bardia.tech>
 
 from os.path import join
-from os import listdir, remove
+from os import remove, replace
 import asyncio
 
 from dbus_next.service import ServiceInterface, method, dbus_property, signal
 from dbus_next.constants import PropertyAccess
 from dbus_next import Variant, DBusError
 
-from mmsd.logging import mmsd_print
+from mmsd.logging import logger
 
 class OfonoMMSMessageInterface(ServiceInterface):
     def __init__(self, mms_dir, uuid, delete_mms_message, verbose=False):
         super().__init__('org.ofono.mms.Message')
-        mmsd_print(f"Initializing MMS Message interface with UUID {uuid}", verbose)
+        logger.debug("Initializing MMS Message interface with UUID %s", uuid)
         self.mms_dir = mms_dir
         self.uuid = uuid
         self.delete_mms_message = delete_mms_message
@@ -34,40 +34,65 @@ class OfonoMMSMessageInterface(ServiceInterface):
 
     @method()
     def MarkRead(self):
-        mmsd_print(f"Marking {self.uuid} as read", self.verbose)
+        logger.debug("Marking %s as read", self.uuid)
+
+        if self.props['Status'].value == 'read':
+            logger.debug("%s is already read", self.uuid)
+            return
 
         self.props['Status'] = Variant('s', 'read')
         self.PropertyChanged('Status', self.props['Status'])
+        self.update_status_file({'read': 'true', 'state': 'read'})
+
+    def set_status(self, status):
+        logger.debug("Setting status of %s to %s", self.uuid, status)
+        self.props['Status'] = Variant('s', status)
+        self.PropertyChanged('Status', self.props['Status'])
+        self.update_status_file({'state': status})
 
+    def update_status_file(self, values):
         status_file = join(self.mms_dir, self.uuid + '.status')
-        with open(status_file, 'r+') as f:
-            lines = f.readlines()
-            for i, line in enumerate(lines):
-                if line.startswith('read='):
-                    lines[i] = 'read=true\n'
-                elif line.startswith('state='):
-                    lines[i] = 'state=read\n'
+        with open(status_file, 'r') as f:
+            lines = f.read().splitlines(True)
+
+        for i, line in enumerate(lines):
+            key = line.partition('=')[0]
+            if key in values:
+                lines[i] = f"{key}={values[key]}\n"
 
-            f.seek(0)
-            f.writelines(lines)
+        # the new values can be shorter than the old ones, write a new file instead of overwriting in place
+        tmp_file = status_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(''.join(lines))
+        replace(tmp_file, status_file)
 
     @method()
     def Delete(self):
-        matching_files = [filename for filename in listdir(self.mms_dir) if self.uuid in filename]
-        mmsd_print(f"Deleting message {self.uuid}: Matching files are: {matching_files}", self.verbose)
+        logger.debug("Deleting message %s", self.uuid)
 
         self.delete_mms_message(self.uuid)
-        for filename in matching_files:
-            file_path = join(self.mms_dir, filename)
-            try:
-                remove(file_path)
-                mmsd_print(f"Removed {filename}", self.verbose)
-            except OSError as e:
-                mmsd_print(f"Error removing {filename}: {e}", self.verbose)
+        for suffix in ('', '.status', '.headers'):
+            self.remove_file(self.uuid + suffix)
+
+        # attachments are numbered from 0 without gaps
+        index = 0
+        while self.remove_file(f"{self.uuid}.attachment.{index}"):
+            index += 1
+
+    def remove_file(self, filename):
+        try:
+            remove(join(self.mms_dir, filename))
+            logger.debug("Removed %s", filename)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logger.debug("Error removing %s: %s", filename, e)
+            return False
 
     @signal()
     def PropertyChanged(self, name, value) -> 'sv':
-        mmsd_print(f"Emitting property changed: name: {name}, value: {value}", self.verbose)
+        logger.debug("Emitting property changed: name: %s, value: %s", name, value)
         return [name, value]
 
     @dbus_property(access=PropertyAccess.READ)
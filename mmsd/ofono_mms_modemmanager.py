@@ -5,16 +5,17 @@ from dbus_next.service import ServiceInterface, method, dbus_property, signal
 from dbus_next.constants import PropertyAccess
 from dbus_next import Variant, DBusError
 
-from mmsd.logging import mmsd_print
+from mmsd.logging import logger
+from mmsd.utils import save_config_section, EMPTY_STR_VARIANT
 
-from os.path import join, exists
+from os.path import join
 import asyncio
 
 class OfonoMMSModemManagerInterface(ServiceInterface):
     def __init__(self, ofono_client, ofono_props, ofono_interfaces, ofono_interface_props, mms_dir, path, verbose=False):
         super().__init__('org.ofono.mms.ModemManager')
         self.modem_name = path
-        mmsd_print("Initializing MMS modem manager interface", verbose)
+        logger.debug("Initializing MMS modem manager interface")
         self.ofono_client = ofono_client
         self.verbose = verbose
         self.ofono_props = ofono_props
@@ -31,9 +32,25 @@ class OfonoMMSModemManagerInterface(ServiceInterface):
             'AutoProcessOnConnection': Variant('b', True),
             'AutoProcessSMSWAP': Variant('b', True)
         }
+        self.set_props_task = None
+        self.settings_saved = False
+        self.set_props_pending = False
+
+    def schedule_set_props(self):
+        # oFono sends property changes in bursts, refresh once per burst
+        self.set_props_pending = True
+        if self.set_props_task is None or self.set_props_task.done():
+            self.set_props_task = asyncio.create_task(self.set_props_soon())
+
+    async def set_props_soon(self):
+        while self.set_props_pending:
+            await asyncio.sleep(0.05)
+            self.set_props_pending = False
+            await self.set_props()
 
     async def set_props(self):
-        mmsd_print("Setting properties", self.verbose)
+        logger.debug("Setting properties")
+        old_props = dict(self.props)
         if 'org.ofono.SimManager' in self.ofono_interface_props:
             if 'SubscriberNumbers' in self.ofono_interface_props['org.ofono.SimManager']:
                 numbers = self.ofono_interface_props['org.ofono.SimManager']['SubscriberNumbers'].value
@@ -48,89 +65,64 @@ class OfonoMMSModemManagerInterface(ServiceInterface):
         if 'org.ofono.ConnectionManager' in self.ofono_interface_props:
             contexts = await self.ofono_interfaces['org.ofono.ConnectionManager'].call_get_contexts()
             for ctx in contexts:
-                ctx_type = ctx[1].get('Type', Variant('s', '')).value
+                ctx_type = ctx[1].get('Type', EMPTY_STR_VARIANT).value
                 if ctx_type.lower() == "mms":
-                    apn = ctx[1].get('AccessPointName', Variant('s', '')).value
-                    proxy = ctx[1].get('MessageProxy', Variant('s', '')).value
-                    mmsc = ctx[1].get('MessageCenter', Variant('s', '')).value
+                    apn = ctx[1].get('AccessPointName', EMPTY_STR_VARIANT).value
+                    proxy = ctx[1].get('MessageProxy', EMPTY_STR_VARIANT).value
+                    mmsc = ctx[1].get('MessageCenter', EMPTY_STR_VARIANT).value
 
                     self.props['CarrierMMSC']= Variant('s', mmsc)
                     self.props['MMS_APN']= Variant('s', apn)
                     self.props['CarrierMMSProxy']= Variant('s', proxy)
         self.SettingsChanged(apn, mmsc, proxy)
-        self.save_settings_to_file()
+        if not self.settings_saved or self.props != old_props:
+            self.save_settings_to_file()
 
     def save_settings_to_file(self):
-        mmsd_print(f"Saving settings to file {self.mms_config_file}", self.verbose)
-
-        modem_manager_section = '[Modem Manager]\n'
-        modem_manager_content = ''.join(f'{key}={variant.value}\n' for key, variant in self.props.items())
-
-        if exists(self.mms_config_file):
-            with open(self.mms_config_file, 'r') as f:
-                lines = f.readlines()
-        else:
-            lines = []
-
-        inside_modem_manager = False
-        new_lines = []
-        section_replaced = False
-
-        for line in lines:
-            if line.strip() == '[Modem Manager]':
-                inside_modem_manager = True
-                new_lines.append(modem_manager_section)
-                new_lines.append(modem_manager_content)
-                section_replaced = True
-            elif line.strip().startswith('[') and inside_modem_manager:
-                inside_modem_manager = False
-                new_lines.append(line)
-            elif not inside_modem_manager:
-                new_lines.append(line)
-
-        if not section_replaced:
-            new_lines.append(modem_manager_section)
-            new_lines.append(modem_manager_content)
-
-        with open(self.mms_config_file, 'w') as f:
-            f.writelines(new_lines)
+        logger.debug("Saving settings to file %s", self.mms_config_file)
+        save_config_section(self.mms_config_file, 'Modem Manager', {key: str(variant.value) for key, variant in self.props.items()})
+        self.settings_saved = True
 
     @method()
     async def PushNotify(self, smswap: 'ay'):
-        mmsd_print(f"Push notify smswap: {smswap}", self.verbose)
+        logger.debug("Push notify smswap: %s", smswap)
 
     @method()
     async def ViewSettings(self) -> 'a{sv}':
-        mmsd_print("View settings", self.verbose)
+        logger.debug("View settings")
         return self.props
 
     @method()
     async def ChangeSettings(self, setting: 's', value: 'v'):
-        mmsd_print(f"Changing setting {setting} to {value}", self.verbose)
-        if setting in self.props:
+        logger.debug("Changing setting %s to %s", setting, value)
+        if setting in self.props and self.props[setting] != value:
             self.props[setting] = value
             self.save_settings_to_file()
 
     @method()
     async def ChangeAllSettings(self, options: 'a{sv}'):
-        mmsd_print(f"Changing settings {options}", self.verbose)
+        logger.debug("Changing settings %s", options)
+        changed = False
         for setting, value in options.items():
-            if setting in self.props:
+            if setting in self.props and self.props[setting] != value:
                 self.props[setting] = value
-        self.save_settings_to_file()
+                changed = True
+
+        if changed:
+            self.save_settings_to_file()
 
     @method()
     async def ProcessMessageQueue(self):
-        mmsd_print("Process message queue", self.verbose)
+        logger.debug("Process message queue")
 
     @signal()
     def BearerHandlerError(self, error) -> 'h':
-        mmsd_print(f"Bearer handler error emitted with error {error}", self.verbose)
+        logger.debug("Bearer handler error emitted with error %s", error)
         return error
 
     @signal()
     def SettingsChanged(self, apn, mmsc, proxy) -> 'sss':
-        mmsd_print(f"Settings changed emitted, APN: {apn}, MMSC, {mmsc}, proxy: {proxy}", self.verbose)
+        logger.debug("Settings changed emitted, APN: %s, MMSC, %s, proxy: %s", apn, mmsc, proxy)
         return [apn, mmsc, proxy]
 
     @dbus_property(access=PropertyAccess.READ)
@@ -163,7 +155,7 @@ class OfonoMMSModemManagerInterface(ServiceInterface):
 
     def ofono_changed(self, name, varval):
         self.ofono_props[name] = varval
-        asyncio.create_task(self.set_props())
+        self.schedule_set_props()
 
     def ofono_client_changed(self, ofono_client):
         self.ofono_client = ofono_client
@@ -172,6 +164,6 @@ class OfonoMMSModemManagerInterface(ServiceInterface):
         def ch(name, varval):
             if iface in self.ofono_interface_props:
                 self.ofono_interface_props[iface][name] = varval
-            asyncio.create_task(self.set_props())
+            self.schedule_set_props()
 
         return ch
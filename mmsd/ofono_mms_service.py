@@ -1,31 +1,45 @@
 # SPDX-License-Identifier: GPL-2.0
 # Copyright (C) 2024 Bardia Moshiri <fakeshell@bardia.tech>
 
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime
-from os.path import join, exists, getsize
-from socket import socket, AF_INET, SOCK_STREAM
-from string import ascii_letters, digits
-from random import choice
-from time import sleep
+from time import strftime, localtime
+from functools import lru_cache
+from os.path import join, getsize
+from base64 import b32encode
+from os import urandom
 from uuid import uuid4
-from io import StringIO
-from re import sub
+from aiohttp import ClientSession, ClientTimeout
 import asyncio
 
 from dbus_next.service import ServiceInterface, method, dbus_property, signal
 from dbus_next.constants import PropertyAccess
 from dbus_next import Variant, DBusError
 
-from mmsd.logging import mmsd_print
+from mmsd.logging import logger
+from mmsd.utils import save_config_section
 
 from mmsdecoder.message import MMSMessage, MMSMessagePage
 
+# every character str.split() treats as whitespace, they are all below U+3001
+_STRIP_WHITESPACE = {codepoint: None for codepoint in range(0x3001) if chr(codepoint).isspace()}
+
+@lru_cache(maxsize=8)
+def proxy_url(proxy):
+    """
+    Turns the CarrierMMSProxy setting into an aiohttp proxy url, or None
+    when the carrier has no proxy. Keyed on the raw setting, so a changed
+    proxy just misses the cache.
+    """
+
+    if not proxy or proxy == 'NULL':
+        return None
+
+    return f"http://{proxy}"
+
 class OfonoMMSServiceInterface(ServiceInterface):
     def __init__(self, ofono_client, ofono_props, ofono_interfaces, ofono_interface_props, mms_dir, ofono_mms_modemmanager_interface, export_mms_message, path, verbose=False):
         super().__init__('org.ofono.mms.Service')
         self.modem_name = path
-        mmsd_print("Initializing MMS Service interface", verbose)
+        logger.debug("Initializing MMS Service interface")
         self.ofono_client = ofono_client
         self.verbose = verbose
         self.ofono_props = ofono_props
@@ -35,7 +49,8 @@ class OfonoMMSServiceInterface(ServiceInterface):
         self.ofono_mms_modemmanager_interface = ofono_mms_modemmanager_interface
         self.export_mms_message = export_mms_message
         self.mms_config_file = join(self.mms_dir, 'mms')
-        self.messages = []
+        self.messages = {}
+        self.message_interfaces = {}
         self.props = {
             'UseDeliveryReports': Variant('b', False),
             'AutoCreateSMIL': Variant('b', True),
@@ -46,12 +61,14 @@ class OfonoMMSServiceInterface(ServiceInterface):
         }
 
         self.loop = asyncio.get_event_loop()
-        self.executor = ThreadPoolExecutor()
+        self.session = None
+        self.send_tasks = set()
+        self.flush_handle = None
+        self.saved_props = None
 
     def generate_random_string(self, length=8):
-        characters = ascii_letters + digits
-        random_string = ''.join(choice(characters) for _ in range(length))
-        return random_string.upper()
+        # base32 keeps the ids upper case letters and digits, 5 random bytes per 8 characters
+        return b32encode(urandom((length * 5 + 7) // 8)).decode()[:length]
 
     def build_message(self, recipients, attachments):
         mms = MMSMessage()
@@ -60,7 +77,7 @@ class OfonoMMSServiceInterface(ServiceInterface):
         if modem_number:
             mms.headers['From'] = f"{modem_number}/TYPE=PLMN"
 
-        recipients = [sub(r'\D', '', recipient) + '/TYPE=PLMN' for recipient in recipients]
+        recipients = [''.join(filter(str.isdecimal, recipient)) + '/TYPE=PLMN' for recipient in recipients]
         mms.headers['To'] = recipients
         mms.headers['Message-Type'] = 'm-send-req'
         mms.headers['MMS-Version'] = '1.1'
@@ -72,210 +89,176 @@ class OfonoMMSServiceInterface(ServiceInterface):
         mms.headers['Content-Type'] = ('application/vnd.wap.multipart.mixed', {})
 
         for attachment in attachments:
-            type = attachment[1].split('/')[0]
+            type = attachment[1].partition('/')[0]
             if type == 'text':
                 try:
-                    with open(attachment[2], 'r') as file:
-                        text_content = file.read()
+                    with open(attachment[2], 'rb') as file:
+                        text_content = file.read().decode('utf-8', errors='replace')
                         text_slide = MMSMessagePage()
                         text_slide.add_text(text_content)
                         mms.add_page(text_slide)
                 except Exception as e:
-                    mmsd_print(f"Failed to process text attachment: {e}", self.verbose)
+                    logger.debug("Failed to process text attachment: %s", e)
             elif type == 'image':
                 try:
                     image_slide = MMSMessagePage()
                     image_slide.add_image(attachment[2])
                     mms.add_page(image_slide)
                 except Exception as e:
-                    mmsd_print(f"Failed to process image attachment: {e}", self.verbose)
+                    logger.debug("Failed to process image attachment: %s", e)
             elif type == 'audio':
                 try:
                     image_slide = MMSMessagePage()
                     image_slide.add_image(attachment[2])
                     mms.add_page(image_slide)
                 except Exception as e:
-                    mmsd_print(f"Failed to process audio attachment: {e}", self.verbose)
+                    logger.debug("Failed to process audio attachment: %s", e)
             else:
-                mmsd_print(f"Attachment type {type} not supported, skipping", self.verbose)
+                logger.debug("Attachment type %s not supported, skipping", type)
 
-        payload = mms.encode()
-        smil = ''.join(mms.smil().split())
+        # the encoder hands back an array('B'), aiohttp only takes bytes as a request body
+        payload = mms.encode().tobytes()
+        smil = mms.smil().translate(_STRIP_WHITESPACE)
 
         return mms, payload, smil, id
 
-    async def send_message_wrapper(self, payload, uuid):
-        await self.loop.run_in_executor(self.executor, self.send_message, payload, uuid)
+    async def send_message(self, payload, uuid, object_path, attempts=5):
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(timeout=ClientTimeout(total=60))
 
-    def send_message(self, payload, uuid):
-        while True:
+        headers = {'Content-Type': 'application/vnd.wap.mms-message'}
+        for attempt in range(attempts):
             try:
-                mmsc = self.ofono_mms_modemmanager_interface.props['CarrierMMSC'].value
-                proxy = self.ofono_mms_modemmanager_interface.props['CarrierMMSProxy'].value
-
-                if ':' not in proxy:
-                    # Since it's an HTTP proxy we can default to port 80
-                    proxy += ':80'
-
-                gw_host, gw_port = proxy.split(':')
-                gw_port = int(gw_port)
-
-                mms_socket = socket(AF_INET, SOCK_STREAM)
-                mms_socket.connect((gw_host, gw_port))
-                mms_socket.send(f"POST {mmsc} HTTP/1.0\r\n".encode())
-                mms_socket.send("Content-Type: application/vnd.wap.mms-message\r\n".encode())
-                mms_socket.send(f"Content-Length: {len(payload)}\r\n\r\n".encode())
+                # read on every attempt, the carrier settings may have been updated since the last one
+                modemmanager_props = self.ofono_mms_modemmanager_interface.props
+                mmsc = modemmanager_props['CarrierMMSC'].value
+                proxy = proxy_url(modemmanager_props['CarrierMMSProxy'].value)
+
+                async with self.session.post(mmsc, data=payload, headers=headers, proxy=proxy) as response:
+                    await response.read()
+                    if response.status == 200:
+                        logger.debug("Message %s sent successfully", uuid)
+                        return True
+
+                    logger.debug("Failed to send message %s. HTTP status: %s", uuid, response.status)
+            except Exception as e:
+                logger.debug("Error sending message: %s. Retrying...", e)
 
-                mms_socket.sendall(payload)
+            if attempt < attempts - 1:
+                await asyncio.sleep(2 ** attempt)
 
-                buf = StringIO()
+        logger.warning("Giving up on sending message %s after %s attempts", uuid, attempts)
+        self.send_failed(object_path)
+        return False
 
-                while True:
-                    data = mms_socket.recv(4096)
-                    if not data:
-                        break
+    def send_failed(self, object_path):
+        # the message was exported as sent, move it back to draft so clients can offer a resend
+        props = self.messages.get(object_path)
+        if props is not None:
+            props['Status'] = Variant('s', 'draft')
 
-                buf.write(data.decode())
+        message_interface = self.message_interfaces.get(object_path)
+        if message_interface is not None:
+            try:
+                message_interface.set_status('draft')
+            except OSError as e:
+                logger.debug("Failed to update status file of %s: %s", object_path, e)
 
-                mms_socket.close()
-                buf.close()
+        self.MessageSendError({'Path': Variant('o', object_path), 'Status': Variant('s', 'draft')})
 
-                mmsd_print(f"Message {uuid} sent successfully", self.verbose)
-                break
-            except Exception as e:
-                mmsd_print(f"Error sending message: {str(e)}. Retrying...", self.verbose)
-                asyncio.sleep(5)
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
     def set_props(self):
-        mmsd_print("Setting properties", self.verbose)
-        self.save_settings_to_file()
+        logger.debug("Setting properties")
+        # called for every oFono property change, write at most once per 250ms
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(0.25, self.flush_settings)
+
+    def flush_settings(self):
+        self.flush_handle = None
+        if self.props != self.saved_props:
+            self.save_settings_to_file()
 
     def save_settings_to_file(self):
-        mmsd_print(f"Saving settings to file {self.mms_config_file}", self.verbose)
-
-        settings_section = '[Settings]\n'
-        settings_content = ''.join(f'{key}={variant.value}\n' for key, variant in self.props.items())
-
-        if exists(self.mms_config_file):
-            with open(self.mms_config_file, 'r') as f:
-                lines = f.readlines()
-        else:
-            lines = []
-
-        inside_settings = False
-        new_lines = []
-        section_replaced = False
-
-        for line in lines:
-            if line.strip() == '[Settings]':
-                inside_settings = True
-                new_lines.append(settings_section)
-                new_lines.append(settings_content)
-                section_replaced = True
-            elif line.strip().startswith('[') and inside_settings:
-                inside_settings = False
-                new_lines.append(line)
-            elif not inside_settings:
-                new_lines.append(line)
-
-        if not section_replaced:
-            new_lines.append(settings_section)
-            new_lines.append(settings_content)
-
-        with open(self.mms_config_file, 'w') as f:
-            f.writelines(new_lines)
+        logger.debug("Saving settings to file %s", self.mms_config_file)
+        save_config_section(self.mms_config_file, 'Settings', {key: str(variant.value) for key, variant in self.props.items()})
+        self.saved_props = dict(self.props)
 
     def create_message_files(self, pdu, uuid, date, id):
-        mmsd_print(f"Saving message {uuid} to disk", self.verbose)
+        logger.debug("Saving message %s to disk", uuid)
         pdu_path = join(self.mms_dir, uuid)
         with open(pdu_path, 'wb') as pdu_file:
             pdu_file.write(pdu)
 
         status_path = join(self.mms_dir, f"{uuid}.status")
         with open(status_path, 'w') as status_file:
-            status_file.write(f"[info]\n")
-            status_file.write(f"read=false\n")
-            status_file.write(f"state=sent\n")
-            status_file.write(f"id={id}\n")
-            status_file.write(f"date={date}\n")
+            status_file.write(f"[info]\nread=false\nstate=sent\nid={id}\ndate={date}\n")
 
     @method()
     def GetMessages(self) -> 'a(oa{sv})':
-        mmsd_print("Getting messages", self.verbose)
-        return self.messages
+        logger.debug("Getting messages")
+        return [[path, props] for path, props in self.messages.items()]
 
     @method()
     def GetProperties(self) -> 'a{sv}':
-        mmsd_print("Getting properties", self.verbose)
+        logger.debug("Getting properties")
         return self.props
 
-    @method()
-    def SendMessage(self, recipients: 'as', smil: 'v', attachments: 'a(sss)') -> 'o':
-        mmsd_print(f"Sending message to recipients {recipients}, attachments {attachments}", self.verbose)
-        uuid = str(uuid4()).replace('-', '1')
+    async def queue_message(self, recipients, attachments):
+        uuid = uuid4().hex
 
-        updated_attachments = []
-        for attachment in attachments:
-            file_path = attachment[2]
-            file_length = getsize(file_path)
-            updated_attachment = list(attachment) + [0, file_length]
-            updated_attachments.append(updated_attachment)
-        attachments = updated_attachments
-
-        mms, payload, smil, id = self.build_message(recipients, attachments)
-        self.loop.create_task(self.send_message_wrapper(payload, uuid))
-        date = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        attachments = [[*attachment, 0, getsize(attachment[2])] for attachment in attachments]
+
+        mms, payload, smil, id = await self.loop.run_in_executor(None, self.build_message, recipients, attachments)
+        date = strftime('%Y-%m-%dT%H:%M:%S', localtime())
         self.create_message_files(payload, uuid, date, id)
         object_path = self.export_mms_message(uuid, 'sent', date, self.ofono_mms_modemmanager_interface.props['ModemNumber'].value, False, recipients, smil, attachments)
 
-        return object_path
+        # the loop only keeps weak references to tasks, hold on to them until the send finishes
+        task = self.loop.create_task(self.send_message(payload, uuid, object_path))
+        self.send_tasks.add(task)
+        task.add_done_callback(self.send_tasks.discard)
 
-    @method(name="SendMessage")
-    def SendMessage2(self, recipients: 'as', options: 'a{sv}', attachments: 'a(sss)') -> 'o':
-        mmsd_print(f"Sending message to recipients {recipients}, options: {options}, attachments {attachments}", self.verbose)
-        uuid = str(uuid4()).replace('-', '1')
+        return object_path
 
-        updated_attachments = []
-        for attachment in attachments:
-            file_path = attachment[2]
-            file_length = getsize(file_path)
-            updated_attachment = list(attachment) + [0, file_length]
-            updated_attachments.append(updated_attachment)
-        attachments = updated_attachments
-
-        mms, payload, smil, id = self.build_message(recipients, attachments)
-        self.loop.create_task(self.send_message_wrapper(payload, uuid))
-        date = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-        self.create_message_files(payload, uuid, date, id)
-        object_path = self.export_mms_message(uuid, 'sent', date, self.ofono_mms_modemmanager_interface.props['ModemNumber'].value, False, recipients, smil, attachments)
+    @method()
+    async def SendMessage(self, recipients: 'as', smil: 'v', attachments: 'a(sss)') -> 'o':
+        logger.debug("Sending message to recipients %s, attachments %s", recipients, attachments)
+        return await self.queue_message(recipients, attachments)
 
-        return object_path
+    @method(name="SendMessage")
+    async def SendMessage2(self, recipients: 'as', options: 'a{sv}', attachments: 'a(sss)') -> 'o':
+        logger.debug("Sending message to recipients %s, options: %s, attachments %s", recipients, options, attachments)
+        return await self.queue_message(recipients, attachments)
 
     @method()
     def SetProperty(self, property: 's', value: 'v'):
-        mmsd_print(f"Setting property {property} to value {value}", self.verbose)
-        if property in self.props:
+        logger.debug("Setting property %s to value %s", property, value)
+        if property in self.props and self.props[property] != value:
             self.props[property] = value
             self.save_settings_to_file()
 
     @signal()
     def MessageAdded(self, path, properties) -> 'oa{sv}':
-        mmsd_print(f"Message added emitted with path {path} and properties {properties}", self.verbose)
+        logger.debug("Message added emitted with path %s and properties %s", path, properties)
         return [path, properties]
 
     @signal()
     def MessageRemoved(self, path) -> 'o':
-        mmsd_print(f"Message removed emitted with path {path}", self.verbose)
+        logger.debug("Message removed emitted with path %s", path)
         return path
 
     @signal()
     def MessageSendError(self, properties) -> 'a{sv}':
-        mmsd_print(f"Message send error emitted with path properties {properties}", self.verbose)
+        logger.debug("Message send error emitted with path properties %s", properties)
         return properties
 
     @signal()
     def MessageReceiveError(self, properties) -> 'a{sv}':
-        mmsd_print(f"Message receive error emitted with path properties {properties}", self.verbose)
+        logger.debug("Message receive error emitted with path properties %s", properties)
         return properties
 
     @dbus_property(access=PropertyAccess.READ)
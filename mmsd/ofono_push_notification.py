@@ -1,27 +1,58 @@
 # SPDX-License-Identifier: GPL-2.0
 # Copyright (C) 2024 Bardia Moshiri <fakeshell@bardia.tech>
 
-from os.path import join, exists, splitext
-from aiohttp import ClientSession
-from array import array
+from os.path import join, splitext
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from uuid import uuid4
-from re import sub, compile
-from os import listdir
+from re import sub, compile, ASCII
+from os import scandir, remove
+from mmap import mmap, ACCESS_READ
+from random import uniform
 import asyncio
 
 from dbus_next.service import ServiceInterface, method, dbus_property, signal
 from dbus_next.constants import PropertyAccess
-from dbus_next import Variant, DBusError
+from dbus_next import DBusError
 
-from mmsd.logging import mmsd_print
+from mmsd.logging import logger
+from mmsd.utils import EMPTY_STR_VARIANT
 
 from mmsdecoder.message import MMSMessage
 
+_RETRY_BASE = 1.0
+_RETRY_CAP = 30.0
+_RETRY_JITTER = 0.5
+_RETRY_WARN_ATTEMPTS = 10
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# anything outside printable ascii, plus double quotes
+_UNPRINTABLE_OR_QUOTE = compile(r'[^\x20\x21\x23-\x7E]+')
+_SMIL_SRC = compile(r'<\w+[^>]*?\ssrc="([^"]*)"', ASCII)
+_STRIP_NEWLINES = str.maketrans('', '', '\r\n')
+_RECEIVED_STATUS = """[info]
+read=false
+state=received
+id={message_id}
+date={sent_time}"""
+
+def write_file(path, data):
+    with open(path, 'wb') as file:
+        file.write(data)
+
+def write_text_file(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+def decode_mms_file(path):
+    # decode straight from the page cache instead of reading the pdu into another buffer
+    with open(path, 'rb') as file, mmap(file.fileno(), 0, access=ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            return MMSMessage.from_data(view)
+
 class OfonoPushNotification(ServiceInterface):
     def __init__(self, bus, ofono_client, ofono_props, ofono_interfaces, ofono_interface_props, mms_dir, export_mms_message, path, verbose=False):
         super().__init__("org.ofono.PushNotificationAgent")
         self.modem_name = path
-        mmsd_print("Initializing oFono push notification agent interface", verbose)
+        logger.debug("Initializing oFono push notification agent interface")
         self.bus = bus
         self.verbose = verbose
         self.ofono_client = ofono_client
@@ -32,28 +63,55 @@ class OfonoPushNotification(ServiceInterface):
         self.export_mms_message = export_mms_message
         self.agent_path = False
         self.registered = False
+        self.session = None
+        self.mms_proxy = None
         self.retry_queue = asyncio.Queue()
-        asyncio.create_task(self.retry_failed_requests())
+        self.requeue_tasks = set()
+        self.network_up = asyncio.Event()
+        self.closed = False
+        # the loop only keeps weak references to tasks, hold on to it so close() can cancel it
+        self.retry_task = asyncio.create_task(self.retry_failed_requests())
 
     async def retry_failed_requests(self):
         while True:
-            transaction_id, content_location, sender, info = await self.retry_queue.get()
-            proxy = await self.get_mms_context_info()
-            response_content = await self.fetch_mms_content(content_location, proxy)
-            if response_content:
-                await self.process_mms_content(response_content, transaction_id, content_location, sender, info)
-            else:
-                self.retry_queue.put_nowait((transaction_id, content_location, sender, info))
-            await asyncio.sleep(5)
+            transaction_id, content_location, sender, info, attempt = await self.retry_queue.get()
+            if await self.download_mms_content(transaction_id, content_location, sender, info):
+                continue
+
+            # never drop the notification, nothing else remembers it. past the cap it's retried every ~30s
+            delay = min(_RETRY_CAP, _RETRY_BASE * 2 ** min(attempt, 16)) * (1 + uniform(-_RETRY_JITTER, _RETRY_JITTER))
+            if attempt + 1 == _RETRY_WARN_ATTEMPTS:
+                logger.warning("Still failing to download %s after %s attempts, retrying every %.0fs", content_location, attempt + 1, _RETRY_CAP)
+            logger.debug("Retry %s for %s failed, next attempt in %.1fs", attempt + 1, content_location, delay)
+            task = asyncio.create_task(self.requeue_after(delay, (transaction_id, content_location, sender, info, attempt + 1)))
+            self.requeue_tasks.add(task)
+            task.add_done_callback(self.requeue_tasks.discard)
+
+    async def requeue_after(self, delay, entry):
+        # retry early once the network comes back, and don't bother waking up while it's gone
+        attached = self.ofono_interface_props.get('org.ofono.ConnectionManager', {}).get('Attached')
+        if attached is not None and not attached.value:
+            delay = None
+
+        try:
+            await asyncio.wait_for(self.network_up.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        self.retry_queue.put_nowait(entry)
+
+    def network_restored(self):
+        # wakes every pending retry, clearing right away turns the event into a pulse
+        self.network_up.set()
+        self.network_up.clear()
 
     async def RegisterAgent(self, path: 'o'):
         if self.registered:
-            mmsd_print(f"Agent already registered at path {path}", self.verbose)
+            logger.debug("Agent already registered at path %s", path)
             return
 
         sim_present = self.ofono_interface_props['org.ofono.SimManager']['Present'].value
         if not sim_present:
-            mmsd_print(f"No SIM present at modem {self.modem_name}", self.verbose)
+            logger.debug("No SIM present at modem %s", self.modem_name)
             return
 
         while True:
@@ -61,200 +119,241 @@ class OfonoPushNotification(ServiceInterface):
                 await self.ofono_interfaces['org.ofono.PushNotification'].call_register_agent(path)
                 break
             except Exception as e:
-                mmsd_print(f"Failed to register oFono push agent: {e}", self.verbose)
+                logger.debug("Failed to register oFono push agent: %s", e)
             await asyncio.sleep(2)
 
         self.bus.export(path, self)
 
         self.agent_path = path
         self.registered = True
-        mmsd_print(f"Agent Registered at path {path}", self.verbose)
+        logger.debug("Agent Registered at path %s", path)
 
     async def UnregisterAgent(self, path: 'o'):
         if not self.registered:
-            mmsd_print(f"Agent not registered at path {path}", self.verbose)
+            logger.debug("Agent not registered at path %s", path)
             return
 
         await self.ofono_interfaces['org.ofono.PushNotification'].call_unregister_agent(path)
 
         self.agent_path = False
         self.registered = False
-        mmsd_print(f"Agent Unregistered at path {path}", self.verbose)
+        logger.debug("Agent Unregistered at path %s", path)
 
     @method()
     async def ReceiveNotification(self, notification: 'ay', info: 'a{sv}'):
-        data = array("B", notification)
-        mms = MMSMessage.from_data(data)
+        # dbus-next hands "ay" over as bytes, which the decoder iterates just like an array
+        mms = await asyncio.get_running_loop().run_in_executor(None, MMSMessage.from_data, notification)
+
+        # bail out on other wap push content before doing any work on the headers
+        if mms.headers.get('Content-Location') is None:
+            logger.debug("Content location is None, is this even MMS? skipping")
+            return
+
         for key, value in mms.headers.items():
             if isinstance(value, str):
-                mms.headers[key] = sub(r'[^\x20-\x7E]+', '', value).replace('"', '')
+                mms.headers[key] = _UNPRINTABLE_OR_QUOTE.sub('', value)
 
-        mmsd_print(f"Received MMS: {mms.headers}, info: {info}", self.verbose)
+        logger.debug("Received MMS: %s, info: %s", mms.headers, info)
 
         transaction_id = mms.headers.get('Transaction-Id')
         content_location = mms.headers.get('Content-Location')
         sender = mms.headers.get('From')
 
-        mmsd_print(f"Transaction-Id: {transaction_id}, Content-Location: {content_location}, From: {sender}", self.verbose)
+        logger.debug("Transaction-Id: %s, Content-Location: %s, From: %s", transaction_id, content_location, sender)
 
-        if content_location is None:
-            mmsd_print("Content location is None, is this even MMS? skipping", self.verbose)
-            return
-
-        proxy = await self.get_mms_context_info()
-        response_content = await self.fetch_mms_content(content_location, proxy)
-        if response_content:
-            await self.process_mms_content(response_content, transaction_id, content_location, sender, info)
-        else:
-            mmsd_print("Failed to get response content, adding to retry queue", self.verbose)
-            self.retry_queue.put_nowait((transaction_id, content_location, sender, info))
+        if not await self.download_mms_content(transaction_id, content_location, sender, info):
+            logger.debug("Failed to get response content, adding to retry queue")
+            self.retry_queue.put_nowait((transaction_id, content_location, sender, info, 0))
 
     @method()
     async def Release(self):
-        mmsd_print(f"Agent released on path {self.agent_path}", self.verbose)
+        logger.debug("Agent released on path %s", self.agent_path)
         self.registered = False
         self.bus.unexport(self.agent_path)
-
-    def export_old_messages(self):
-        export_entries = {}
-
-        for filename in listdir(self.mms_dir):
-            if filename.endswith('.status'):
-                basename = filename.rsplit('.status', 1)[0]
-                attachment_count = 0
-                headers_file = basename + '.headers'
-
-                if exists(join(self.mms_dir, headers_file)):
-                    for attachment_file in listdir(self.mms_dir):
-                        if attachment_file.startswith(basename + '.attachment.'):
-                            attachment_count += 1
-
-                    if attachment_count >= 2:
-                        status_path = join(self.mms_dir, filename)
-
-                        if exists(status_path):
-                            status_data = {
-                                'state': None,
-                                'date': None,
-                                'sender': None,
-                                'delivery_report': None,
-                                'smil_data': None,
-                                'attachments': []
-                            }
-
-                            with open(status_path, 'r') as file:
-                                for line in file:
-                                    if line.startswith('state='):
-                                        status_data['state'] = line.split('=')[1].strip()
-                                    elif line.startswith('date='):
-                                        status_data['date'] = line.split('=')[1].strip()
-
-                            smil_file = join(self.mms_dir, basename)
-                            if exists(smil_file):
-                                with open(smil_file, 'rb') as smil_data:
-                                    mms_smil = MMSMessage.from_data(smil_data.read())
-
-                                    if "Delivery-Report" in mms_smil.headers and mms_smil.headers['Delivery-Report']:
-                                        status_data['delivery_report'] = mms_smil.headers['Delivery-Report']
-                                    else:
-                                        status_data['delivery_report'] = False
-
-                                    if mms_smil.headers['From']:
-                                        status_data['sender'] = mms_smil.headers['From'].split('/')[0]
-                                    else:
-                                        status_data['sender'] = ''
-
-                                    smil_src = len(mms_smil.data_parts)
-                                    for index, part in enumerate(mms_smil.data_parts):
-                                        attachment_path = join(self.mms_dir, f"{basename}.attachment.{index}")
-
-                                        if 'application/smil' in part.content_type:
-                                            # smil should be added to smil prop only, not to attachments
-                                            smil_data = part.data.decode('utf-8').replace("\n", "").replace("\r", "")
-                                            status_data['smil_data'] = smil_data
-                                            smil_src = self.extract_smil_src(smil_data)
-                                            if smil_src is None:
-                                                num_attachments = len(mms_smil.data_parts)
-                                        else:
-                                            if smil_src:
-                                                attachment_info = [f'<{smil_src[index-1]}>', part.content_type, attachment_path, 0, len(part.data)]
-                                                status_data['attachments'].append(attachment_info)
-                                            else:
-                                                attachment_info = [f'<1>', part.content_type, attachment_path, 0, len(part.data)] # content types like vcard
-                                                status_data['attachments'].append(attachment_info)
-
-                            export_entries[basename] = status_data
+        await self.close()
+
+    def get_session(self):
+        if self.closed:
+            raise RuntimeError("push notification agent is closed")
+
+        # one session per agent so successive downloads reuse the MMSC connection
+        if self.session is None or self.session.closed:
+            # no overall limit, a large mms on a slow link can take minutes. only stalled connections time out
+            timeout = ClientTimeout(total=None, sock_connect=30, sock_read=60)
+            self.session = ClientSession(connector=TCPConnector(limit=4, ttl_dns_cache=300, keepalive_timeout=60), timeout=timeout)
+        return self.session
+
+    async def close(self):
+        # stop retrying first, otherwise the next retry would open a new session behind our back
+        self.closed = True
+        self.retry_task.cancel()
+        for task in list(self.requeue_tasks):
+            task.cancel()
+
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def export_old_messages(self):
+        # the directory scan, status reads and PDU decoding all block, keep them off the loop
+        export_entries = await asyncio.to_thread(self.scan_old_messages)
 
         for basename, entry in export_entries.items():
-            mmsd_print(f"re-exporting old message {basename}", self.verbose)
+            logger.debug("re-exporting old message %s", basename)
             self.export_mms_message(basename, entry['state'], entry['date'], entry['sender'], entry['delivery_report'], [], entry['smil_data'], entry['attachments'])
 
-    async def fetch_mms_content(self, url, proxy):
-        async with ClientSession() as session:
-            try:
-                mmsd_print(f"Fetching URL: {url} using proxy: {proxy}", self.verbose)
-                if proxy:
-                    async with session.get(url, proxy=f"http://{proxy}") as response:
-                        mmsd_print(f"Response status: {response.status}", self.verbose)
-                        if response.status == 200:
-                            content = await response.read()
-                            mmsd_print(f"Content length: {len(content)}", self.verbose)
-                            return content
-                        else:
-                            mmsd_print(f"Failed to fetch content. HTTP status: {response.status}", self.verbose)
-                else:
-                    async with session.get(url) as response:
-                        mmsd_print(f"Response status: {response.status}", self.verbose)
-                        if response.status == 200:
-                            content = await response.read()
-                            mmsd_print(f"Content length: {len(content)}", self.verbose)
-                            return content
+    def scan_old_messages(self):
+        export_entries = {}
+
+        # one pass over the directory, bucketing every file under its message basename
+        buckets = {}
+        with scandir(self.mms_dir) as it:
+            for entry in it:
+                name = entry.name
+                if name.endswith('.status'):
+                    buckets.setdefault(name[:-len('.status')], {})['status'] = entry.path
+                elif name.endswith('.headers'):
+                    buckets.setdefault(name[:-len('.headers')], {})['headers'] = True
+                elif '.attachment.' in name:
+                    bucket = buckets.setdefault(name.split('.attachment.', 1)[0], {})
+                    bucket['attachments'] = bucket.get('attachments', 0) + 1
+                elif '.' not in name and entry.is_file():
+                    buckets.setdefault(name, {})['pdu'] = True
+
+        for basename, bucket in buckets.items():
+            if 'status' not in bucket or 'headers' not in bucket or bucket.get('attachments', 0) < 2:
+                continue
+
+            status_path = bucket['status']
+            status_data = {
+                'state': None,
+                'date': None,
+                'sender': None,
+                'delivery_report': None,
+                'smil_data': None,
+                'attachments': []
+            }
+
+            with open(status_path, 'r') as file:
+                for line in file:
+                    if line.startswith('state='):
+                        status_data['state'] = line.split('=')[1].strip()
+                    elif line.startswith('date='):
+                        status_data['date'] = line.split('=')[1].strip()
+
+            smil_file = join(self.mms_dir, basename)
+            if bucket.get('pdu'):
+                with open(smil_file, 'rb') as smil_data:
+                    mms_smil = MMSMessage.from_data(smil_data.read())
+
+                    if "Delivery-Report" in mms_smil.headers and mms_smil.headers['Delivery-Report']:
+                        status_data['delivery_report'] = mms_smil.headers['Delivery-Report']
+                    else:
+                        status_data['delivery_report'] = False
+
+                    if mms_smil.headers['From']:
+                        status_data['sender'] = mms_smil.headers['From'].partition('/')[0]
+                    else:
+                        status_data['sender'] = ''
+
+                    smil_src = len(mms_smil.data_parts)
+                    for index, part in enumerate(mms_smil.data_parts):
+                        attachment_path = join(self.mms_dir, f"{basename}.attachment.{index}")
+
+                        if 'application/smil' in part.content_type:
+                            # smil should be added to smil prop only, not to attachments
+                            smil_data = part.data.decode('utf-8').translate(_STRIP_NEWLINES)
+                            status_data['smil_data'] = smil_data
+                            smil_src = self.extract_smil_src(smil_data)
+                            if smil_src is None:
+                                num_attachments = len(mms_smil.data_parts)
                         else:
-                            mmsd_print(f"Failed to fetch content. HTTP status: {response.status}", self.verbose)
-            except Exception as e:
-                mmsd_print(f"Failed to download SMIL: {e}", self.verbose)
-            return None
+                            if smil_src:
+                                attachment_info = [f'<{smil_src[index-1]}>', part.content_type, attachment_path, 0, len(part.data)]
+                                status_data['attachments'].append(attachment_info)
+                            else:
+                                attachment_info = [f'<1>', part.content_type, attachment_path, 0, len(part.data)] # content types like vcard
+                                status_data['attachments'].append(attachment_info)
+
+            export_entries[basename] = status_data
+
+        return export_entries
+
+    async def download_mms_content(self, transaction_id, content_location, sender, info):
+        uuid = uuid4().hex
+        smil_path = join(self.mms_dir, uuid)
 
-    async def process_mms_content(self, content, transaction_id, content_location, sender, info):
-        uuid = str(uuid4()).replace('-', '1')
+        proxy = await self.get_mms_context_info()
+        if not await self.fetch_mms_content(content_location, proxy, smil_path):
+            return False
+
+        await self.process_mms_content(uuid, transaction_id, content_location, sender, info)
+        return True
+
+    async def save_response(self, response, path):
+        size = 0
+        with open(path, 'wb') as file:
+            async for chunk in response.content.iter_chunked(_DOWNLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(file.write, chunk)
+                size += len(chunk)
+        return size
+
+    async def fetch_mms_content(self, url, proxy, path):
+        size = 0
+        try:
+            session = self.get_session()
+            logger.debug("Fetching URL: %s using proxy: %s", url, proxy)
+            async with session.get(url, proxy=f"http://{proxy}" if proxy else None) as response:
+                logger.debug("Response status: %s", response.status)
+                if response.status == 200:
+                    size = await self.save_response(response, path)
+                    logger.debug("Content length: %s", size)
+                else:
+                    logger.debug("Failed to fetch content. HTTP status: %s", response.status)
+        except Exception as e:
+            logger.debug("Failed to download SMIL: %s", e)
+            size = 0
+
+        if size:
+            logger.debug("SMIL successfully saved to %s", path)
+            return True
+
+        # don't leave a partial or empty pdu behind for export_old_messages to trip over
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+        return False
+
+    async def process_mms_content(self, uuid, transaction_id, content_location, sender, info):
         smil_path = join(self.mms_dir, uuid)
         status_path = join(self.mms_dir, f"{uuid}.status")
         headers_path = join(self.mms_dir, f"{uuid}.headers")
 
-        with open(smil_path, 'wb') as file:
-            file.write(content)
-            mmsd_print(f"SMIL successfully saved to {smil_path}", self.verbose)
-
-        mms_smil = MMSMessage.from_data(content)
+        mms_smil = await asyncio.get_running_loop().run_in_executor(None, decode_mms_file, smil_path)
 
-        with open(headers_path, 'w') as headers_file:
-            for header_key, header_value in mms_smil.headers.items():
-                headers_file.write(f"{header_key}={header_value}\n")
-            mmsd_print(f"Headers successfully saved to {headers_path}", self.verbose)
+        headers = ''.join(f"{header_key}={header_value}\n" for header_key, header_value in mms_smil.headers.items())
 
         sent_time = info['SentTime'].value if 'SentTime' in info else ''
         message_id = mms_smil.headers.get('Transaction-Id') or mms_smil.headers.get('Message-ID') or transaction_id or ''
 
-        meta_info = f"""[info]
-read=false
-state=received
-id={message_id}
-date={sent_time}"""
+        meta_info = _RECEIVED_STATUS.format(message_id=message_id, sent_time=sent_time)
 
-        with open(status_path, 'w') as status_file:
-            status_file.write(meta_info)
-            mmsd_print(f"Meta info successfully saved to {status_path}", self.verbose)
+        # headers, status and attachments are independent files, write them all in one batch
+        file_writes = [
+            asyncio.to_thread(write_text_file, headers_path, headers),
+            asyncio.to_thread(write_text_file, status_path, meta_info),
+        ]
 
         attachments = []
         smil_src = len(mms_smil.data_parts)
         for index, part in enumerate(mms_smil.data_parts):
             attachment_path = join(self.mms_dir, f"{uuid}.attachment.{index}")
-            with open(attachment_path, 'wb') as file:
-                mmsd_print(f"Writing attachment with index {index} of content type {part.content_type} to {attachment_path}", self.verbose)
-                file.write(part.data)
+            logger.debug("Writing attachment with index %s of content type %s to %s", index, part.content_type, attachment_path)
+            file_writes.append(asyncio.to_thread(write_file, attachment_path, part.data))
 
             if 'application/smil' in part.content_type:
-                smil_data = part.data.decode('utf-8').replace("\n", "").replace("\r", "")
+                smil_data = part.data.decode('utf-8').translate(_STRIP_NEWLINES)
                 smil_src = self.extract_smil_src(smil_data)
                 if smil_src is None:
                     num_attachments = len(mms_smil.data_parts)
@@ -266,8 +365,12 @@ date={sent_time}"""
                     attachment_info = [f'<1>', part.content_type, attachment_path, 0, len(part.data)] # content types like vcard
                     attachments.append(attachment_info)
 
+        # every file has to be on disk before the message is exported
+        await asyncio.gather(*file_writes)
+        logger.debug("Headers and meta info successfully saved to %s and %s", headers_path, status_path)
+
         if smil_data:
-            sender_number = sender.split('/')[0]
+            sender_number = sender.partition('/')[0]
             recipients = []
             numbers = []
             to_numbers = mms_smil.headers.get('To', [])
@@ -283,19 +386,26 @@ date={sent_time}"""
             self.export_mms_message(uuid, 'received', sent_time, sender_number, delivery_report, recipients, smil_data, attachments)
 
     async def get_mms_context_info(self):
+        if self.mms_proxy is not None:
+            return self.mms_proxy
+
         proxy = ''
         if 'org.ofono.ConnectionManager' in self.ofono_interfaces:
             contexts = await self.ofono_interfaces['org.ofono.ConnectionManager'].call_get_contexts()
             for ctx in contexts:
-                name = ctx[1].get('Type', Variant('s', '')).value
+                name = ctx[1].get('Type', EMPTY_STR_VARIANT).value
                 if name.lower() == "mms":
                     proxy = ctx[1]['MessageProxy'].value
+                    # only cache once we actually saw the mms context
+                    self.mms_proxy = proxy
         return proxy
 
+    def mms_context_changed(self):
+        self.mms_proxy = None
+
     def extract_smil_src(self, xml_string):
-        src_pattern = compile(r'<(\w+)\s+[^>]*src="([^"]*)"[^>]*>')
-        sources = src_pattern.findall(xml_string)
-        src_list = [splitext(match[1])[0] for match in sources]
+        sources = _SMIL_SRC.findall(xml_string)
+        src_list = [splitext(src)[0] for src in sources]
         if src_list:
             return src_list
         else:
@@ -311,5 +421,9 @@ date={sent_time}"""
         def ch(name, varval):
             if iface in self.ofono_interface_props:
                 self.ofono_interface_props[iface][name] = varval
+            if iface == 'org.ofono.ConnectionManager':
+                self.mms_context_changed()
+                if name == 'Attached' and varval.value:
+                    self.network_restored()
 
         return ch
@@ -2,6 +2,14 @@
 # Copyright (C) 2024 Bardia Moshiri <fakeshell@bardia.tech>
 
 import asyncio
+from configparser import ConfigParser
+from io import StringIO
+from os import replace, stat
+
+from dbus_next import Variant
+
+# default for optional string properties, e.g. a context without a Type
+EMPTY_STR_VARIANT = Variant('s', '')
 
 def async_retryable(times=0):
     """
@@ -44,3 +52,38 @@ def async_locked(func):
 
     func.__lock = asyncio.Lock()
     return wrapper
+
+_config_files = {}
+
+def config_mtime(path):
+    try:
+        return stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def save_config_section(path, section, values):
+    """
+    Replaces one section of an ini style config file, keeping the others.
+
+    The parsed file is kept in memory together with its mtime, so every
+    writer of the same path shares one view of it and saves only re-read
+    the file when something else changed it on disk.
+    """
+
+    config, mtime = _config_files.get(path, (None, None))
+    if config is None or mtime != config_mtime(path):
+        config = ConfigParser(interpolation=None, strict=False)
+        config.optionxform = str  # keep the key case
+        config.read(path)
+
+    config[section] = values
+    buf = StringIO()
+    config.write(buf, space_around_delimiters=False)
+
+    # write a whole new file and swap it in, a crash mid-write must not truncate the config
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(buf.getvalue())
+    replace(tmp_path, path)
+
+    _config_files[path] = (config, config_mtime(path))
@@ -4,6 +4,8 @@
 
 """Iterator with "value preview" capability."""
 
+from collections import deque
+
 class PreviewIterator:
     """
     An ``iter`` wrapper class providing a "previewable" iterator.
@@ -19,7 +21,7 @@ class PreviewIterator:
     """
     def __init__(self, data):
         self._it = iter(data)
-        self._cached_values = []
+        self._cached_values = deque()
         self._preview_pos = 0
 
     def __iter__(self):
@@ -27,8 +29,8 @@ class PreviewIterator:
 
     def __next__(self):
         self.reset_preview()
-        if len(self._cached_values) > 0:
-            return self._cached_values.pop(0)
+        if self._cached_values:
+            return self._cached_values.popleft()
         return next(self._it)
 
     def preview(self):
@@ -149,6 +149,9 @@ WELL_KNOWN_CONTENT_TYPES = [
     'application/vnd.oma.drm.rights+wbxml',
 ]
 
+# Reverse lookup for the encoder, saves a linear list.index() per content type
+WELL_KNOWN_CONTENT_TYPE_INDEX = {content_type: index for index, content_type in enumerate(WELL_KNOWN_CONTENT_TYPES)}
+
 # Well-known character sets (table 42 of [5])
 # Format {<assinged_number> : <charset>}
 # Note that the assigned number is the same as the IANA MIBEnum value
@@ -1612,10 +1615,10 @@ class Encoder:
                  values
         :rtype: list
         """
-        if content_type in WELL_KNOWN_CONTENT_TYPES:
+        if content_type in WELL_KNOWN_CONTENT_TYPE_INDEX:
             # Short-integer encoding
             val = Encoder.encode_short_integer(
-                    WELL_KNOWN_CONTENT_TYPES.index(content_type))
+                    WELL_KNOWN_CONTENT_TYPE_INDEX[content_type])
         else:
             val = Encoder.encode_text_string(content_type)
 
@@ -1864,8 +1867,8 @@ class Encoder:
         :rtype: list
         """
         # See if this value is in the table of well-known content types
-        if media_type in WELL_KNOWN_CONTENT_TYPES:
-            value = WELL_KNOWN_CONTENT_TYPES.index(media_type)
+        if media_type in WELL_KNOWN_CONTENT_TYPE_INDEX:
+            value = WELL_KNOWN_CONTENT_TYPE_INDEX[media_type]
         else:
             value = media_type
 